@@ -1,355 +1,914 @@
-import yaml
-import requests
-from pathlib import Path
-import logging
-from typing import Optional, Dict, Any, List
-import argparse
-import csv
-from datetime import datetime
-import os
-import json
-
-class FHIRClient:
-    def __init__(self, cred_file: str = "cred.yml"):
-        self.logger = logging.getLogger(__name__)
-        self.access_token = None
-        self._load_credentials(cred_file)
-        
-    def _load_credentials(self, cred_file: str) -> None:
-        """Load credentials from YAML file."""
-        try:
-            cred_path = Path(__file__).parent / cred_file
-            with open(cred_path, 'r') as file:
-                creds = yaml.safe_load(file)
-                self.client_id = creds['client_id']
-                self.client_secret = creds['client_secret']
-                self.token_endpoint = creds['token_endpoint']
-                self.fhir_endpoint = creds['fhir_endpoint']
-        except Exception as e:
-            self.logger.error(f"Error loading credentials: {str(e)}")
-            raise
-
-    def get_access_token(self) -> Optional[str]:
-        """Obtain OAuth2 access token."""
-        try:
-            data = {
-                'grant_type': 'client_credentials',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret
-            }
-            
-            response = requests.post(self.token_endpoint, data=data)
-            response.raise_for_status()
-            
-            token_data = response.json()
-            self.access_token = token_data.get('access_token')
-            return self.access_token
-            
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Error obtaining access token: {str(e)}")
-            return None
-
-    def make_fhir_request(self, resource_type: str, resource_id: Optional[str] = None, 
-                         parameters: Optional[Dict[str, Any]] = None) -> Optional[Dict]:
-        """Make a FHIR API request."""
-        if not self.access_token:
-            self.get_access_token()
-            if not self.access_token:
-                return None
-
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Accept': 'application/fhir+json',
-            'Content-Type': 'application/fhir+json'
-        }
-
-        # Construct the URL
-        url = f"{self.fhir_endpoint}/{resource_type}"
-        if resource_id:
-            url = f"{url}/{resource_id}"
-
-        try:
-            # Use POST for batch translate operations
-            if resource_type == "ConceptMap/$translate":
-                # Create FHIR Parameters resource for single code or batch
-                if 'coding' in parameters:
-                    # Batch translate format
-                    data = {
-                        "resourceType": "Parameters",
-                        "parameter": [
-                            {
-                                "name": "coding",
-                                "valueCoding": coding
-                            } for coding in parameters['coding']
-                        ]
-                    }
-                else:
-                    # Single code translate format
-                    data = {
-                        "resourceType": "Parameters",
-                        "parameter": [
-                            {
-                                "name": "coding",
-                                "valueCoding": {
-                                    "system": parameters['system'],
-                                    "code": parameters['code']
-                                }
-                            }
-                        ]
-                    }
-                response = requests.post(url, headers=headers, json=data)
-            else:
-                response = requests.get(url, headers=headers, params=parameters)
-
-            self.logger.info(f"Request URL: {response.url}")
-            self.logger.info(f"Request Body: {data if 'data' in locals() else 'None'}")
-            self.logger.info(f"Response Status: {response.status_code}")
-            self.logger.info(f"Response Content: {response.text}")
-            
-            response.raise_for_status()
-            return response.json()
-            
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Error making FHIR request: {str(e)}")
-            if hasattr(e, 'response'):
-                self.logger.error(f"Response content: {e.response.text}")
-                self.logger.error(f"Request headers: {e.response.request.headers}")
-            return None
-
-    def map_snomed_to_icd10(self, snomed_code: str) -> Optional[Dict]:
-        """Map a SNOMED CT code to ICD-10 using FHIR ConceptMap."""
-        parameters = {
-            'code': snomed_code,
-            'system': 'http://snomed.info/sct'
-        }
-        
-        # Add debug logging
-        self.logger.info(f"Mapping SNOMED CT code: {snomed_code}")
-        self.logger.info(f"Parameters: {parameters}")
-        
-        return self.make_fhir_request(
-            resource_type="ConceptMap/$translate",
-            parameters=parameters
-        )
-
-    def map_snomed_codes_batch(self, snomed_codes: List[str]) -> Optional[Dict]:
-        """Map multiple SNOMED CT codes to ICD-10 using FHIR ConceptMap batch translate."""
-        parameters = {
-            'coding': [
-                {
-                    'system': 'http://snomed.info/sct',
-                    'code': code
-                } for code in snomed_codes
-            ]
-        }
-        
-        # Add debug logging
-        self.logger.info(f"Mapping SNOMED CT codes batch: {snomed_codes}")
-        self.logger.info(f"Parameters: {parameters}")
-        
-        result = self.make_fhir_request(
-            resource_type="ConceptMap/$translate",
-            parameters=parameters
-        )
-        
-        # Add response validation
-        if result and 'parameter' in result:
-            matches_count = sum(1 for param in result['parameter'] if param['name'] == 'match')
-            self.logger.info(f"Received {matches_count} matches for {len(snomed_codes)} input codes")
-            if matches_count != len(snomed_codes):
-                self.logger.warning("Number of matches doesn't match number of input codes!")
-        
-        return result
-
-def load_existing_mappings(output_file='output_codes.csv') -> Dict[str, str]:
-    """Load existing SNOMED to ICD10 mappings from output file."""
-    existing_mappings = {}
-    try:
-        if os.path.exists(output_file):
-            with open(output_file, 'r', newline='') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    existing_mappings[row['SNOMED']] = row['ICD10']
-    except Exception as e:
-        logging.error(f"Error loading existing mappings: {str(e)}")
-    return existing_mappings
-
-def get_last_id(output_file):
-    """Get the last used ID from the CSV file"""
-    try:
-        if os.path.exists(output_file):
-            with open(output_file, 'r', newline='') as csvfile:
-                reader = csv.reader(csvfile)
-                next(reader)  # Skip header
-                last_id = 0
-                for row in reader:
-                    if row and row[0].isdigit():  # Ensure the ID column contains a number
-                        last_id = int(row[0])
-                return last_id
-    except Exception as e:
-        logging.error(f"Error reading last ID: {str(e)}")
-    return 0
-
-def process_batch_codes(input_file, output_file='output_codes.csv', failed_file='failed_codes.csv', full_refresh=False):
-    client = FHIRClient()
-    os.makedirs('output/json', exist_ok=True)
-    
-    # Initialize counters
-    total_codes = 0
-    skipped_codes = 0
-    processed_codes = 0
-    error_codes = 0
-    
-    # Load existing mappings if not doing a full refresh
-    existing_mappings = {} if full_refresh else load_existing_mappings(output_file)
-    
-    # Get the next ID number for successful mappings
-    current_id = 1 if full_refresh else get_last_id(output_file) + 1
-    
-    # Get the next ID number for failed mappings
-    failed_id = 1 if full_refresh else get_last_id(failed_file) + 1
-    
-    # Open output files in appropriate mode
-    mode = 'w' if full_refresh else 'a'
-    file_exists = os.path.exists(output_file)
-    failed_exists = os.path.exists(failed_file)
-    
-    with open(output_file, mode, newline='') as csvfile, \
-         open(failed_file, mode, newline='') as failedfile:
-        writer = csv.writer(csvfile)
-        failed_writer = csv.writer(failedfile)
-        
-        # Write headers if needed
-        if full_refresh or not file_exists:
-            writer.writerow(['ID', 'SNOMED', 'ICD10', 'TIMESTAMP'])
-        if full_refresh or not failed_exists:
-            failed_writer.writerow(['ID', 'SNOMED', 'ERROR', 'TIMESTAMP'])
-        
-        with open(input_file, 'r') as infile:
-            for snomed_code in infile:
-                snomed_code = snomed_code.strip()
-                if not snomed_code:
-                    continue
-                
-                total_codes += 1
-                
-                # Skip if code already exists and not doing full refresh
-                if not full_refresh and snomed_code in existing_mappings:
-                    skipped_codes += 1
-                    logging.info(f"Skipping {snomed_code} - already mapped to {existing_mappings[snomed_code]}")
-                    continue
-                    
-                try:
-                    # Get the raw response
-                    response = client.map_snomed_to_icd10(snomed_code)
-                    
-                    # Save JSON response
-                    json_filename = f'output/json/{snomed_code}.json'
-                    with open(json_filename, 'w') as f:
-                        json.dump(response, f, indent=2)
-                    
-                    # Extract ICD10 code
-                    icd10_code = extract_icd10_from_response(response)
-                    
-                    if icd10_code:  # Successful mapping
-                        writer.writerow([
-                            current_id,
-                            snomed_code,
-                            icd10_code,
-                            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        ])
-                        current_id += 1
-                        processed_codes += 1
-                        logging.info(f"Processed {snomed_code} -> {icd10_code}")
-                    else:  # No mapping found
-                        error_codes += 1
-                        failed_writer.writerow([
-                            failed_id,
-                            snomed_code,
-                            "No mapping found",
-                            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        ])
-                        failed_id += 1
-                        logging.error(f"No mapping found for code {snomed_code}")
-                    
-                except Exception as e:
-                    error_codes += 1
-                    logging.error(f"Error processing code {snomed_code}: {str(e)}")
-                    failed_writer.writerow([
-                        failed_id,
-                        snomed_code,
-                        f"ERROR: {str(e)}",
-                        datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    ])
-                    failed_id += 1
-
-    # Print summary statistics
-    print("\nProcessing Summary:")
-    print(f"Total codes found: {total_codes}")
-    print(f"Codes skipped (already mapped): {skipped_codes}")
-    print(f"Codes processed successfully: {processed_codes}")
-    print(f"Codes with errors/no mapping: {error_codes}")
-
-def extract_icd10_from_response(response):
-    """Extract ICD-10 code from the FHIR response"""
-    try:
-        if not response or 'parameter' not in response:
-            return ''
-
-        # First check if there's a match at all
-        result_param = next((p for p in response['parameter'] if p['name'] == 'result'), None)
-        if not result_param or not result_param.get('valueBoolean', False):
-            return ''
-
-        # Find the match parameter
-        match_param = next((p for p in response['parameter'] if p['name'] == 'match'), None)
-        if not match_param or 'part' not in match_param:
-            return ''
-
-        # Look for concept parts with ICD-10 codes
-        for part in match_param['part']:
-            if (part.get('name') == 'concept' and 
-                'valueCoding' in part and 
-                part['valueCoding'].get('system') == 'http://hl7.org/fhir/sid/icd-10-am'):
-                return part['valueCoding'].get('code', '')
-
-        return ''  # Return empty string if no mapping found
-        
-    except Exception as e:
-        logging.error(f"Error extracting ICD-10 code: {str(e)}")
-        return ''
-
-def main():
-    parser = argparse.ArgumentParser(description='Map SNOMED CT codes to ICD-10')
-    parser.add_argument('--batch', type=str, help='Input file containing SNOMED CT codes (one per line)')
-    parser.add_argument('--code', type=str, help='Single SNOMED CT code to map')
-    parser.add_argument('--full-refresh', action='store_true', help='Clear output file and process all codes')
-    args = parser.parse_args()
-    
-    # Set up logging
-    logging.basicConfig(level=logging.DEBUG)
-    
-    # Create FHIR client instance
-    client = FHIRClient()
-    
-    if args.batch:
-        # Process batch file
-        process_batch_codes(args.batch, full_refresh=args.full_refresh)
-        print(f"Results written to output_codes.csv")
-    elif args.code:
-        # Create a temporary file with the single code
-        temp_file = 'temp_code.txt'
-        with open(temp_file, 'w') as f:
-            f.write(args.code)
-        
-        # Process as batch
-        process_batch_codes(temp_file, full_refresh=args.full_refresh)
-        
-        # Clean up temp file
-        os.remove(temp_file)
-        print(f"Results written to output_codes.csv")
-    else:
-        parser.print_help()
-
-if __name__ == "__main__":
+import yaml
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pathlib import Path
+import logging
+from typing import Optional, Dict, Any, List
+import argparse
+import asyncio
+import csv
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import aiohttp
+import orjson
+from datetime import datetime
+import os
+import re
+import sys
+import time
+
+# Prebuilt $translate body fragments - interpolating validated codes into
+# these skips rebuilding the Parameters dict tree and its json.dumps on
+# every call
+_PARAMS_TEMPLATE = '{"resourceType":"Parameters","parameter":[%s]}'
+_CODING_TEMPLATE = '{"name":"coding","valueCoding":{"system":"http://snomed.info/sct","code":"%s"}}'
+
+# SNOMED CT codes are purely numeric; only such codes may be interpolated
+# into the raw body template
+_SNOMED_CODE_RE = re.compile(r'^[0-9]+$')
+
+# Interned vocabulary for the response-extraction hot loops: interning
+# incoming names lets 'is' replace full string comparison on a fixed set
+# of parameter names
+_RESULT = sys.intern('result')
+_MATCH = sys.intern('match')
+_CONCEPT = sys.intern('concept')
+_ICD10_SYSTEM = sys.intern('http://hl7.org/fhir/sid/icd-10-am')
+
+class FHIRClient:
+    def __init__(self, cred_file: str = "cred.yml"):
+        self.logger = logging.getLogger(__name__)
+        self.access_token = None
+        self._token_expiry = 0.0
+        self._token_lock = threading.Lock()
+        self._load_credentials(cred_file)
+
+        # Reuse one session for all requests so connections are pooled
+        # and kept alive instead of re-handshaking TCP+TLS per call
+        self.session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+        # Pool sized above the worker count so threads don't serialize
+        # waiting for a free connection
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=32,
+            max_retries=retries
+        ))
+        # Accept only - a session-wide Content-Type would override the
+        # form encoding requests picks for the OAuth token POST
+        self.session.headers.update({
+            'Accept': 'application/fhir+json'
+        })
+        
+    def _load_credentials(self, cred_file: str) -> None:
+        """Load credentials from YAML file."""
+        try:
+            cred_path = Path(__file__).parent / cred_file
+            with open(cred_path, 'r') as file:
+                creds = yaml.safe_load(file)
+                self.client_id = creds['client_id']
+                self.client_secret = creds['client_secret']
+                self.token_endpoint = creds['token_endpoint']
+                self.fhir_endpoint = creds['fhir_endpoint']
+        except Exception as e:
+            self.logger.error("Error loading credentials: %s", e)
+            raise
+
+    def get_access_token(self, force: bool = False) -> Optional[str]:
+        """Obtain OAuth2 access token. Safe to call from multiple threads."""
+        with self._token_lock:
+            # Another thread may have refreshed while we waited on the lock
+            if not force and self.access_token and time.monotonic() < self._token_expiry:
+                return self.access_token
+            return self._refresh_access_token()
+
+    def _refresh_access_token(self) -> Optional[str]:
+        try:
+            data = {
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret
+            }
+            
+            response = self.session.post(self.token_endpoint, data=data)
+            response.raise_for_status()
+            
+            token_data = orjson.loads(response.content)
+            self.access_token = token_data.get('access_token')
+            # Refresh a minute early so in-flight requests never carry a
+            # token that expires mid-request
+            expires_in = int(token_data.get('expires_in', 3600))
+            self._token_expiry = time.monotonic() + expires_in - 60
+            return self.access_token
+
+        except requests.exceptions.RequestException as e:
+            self.logger.error("Error obtaining access token: %s", e)
+            return None
+
+    def make_fhir_request(self, resource_type: str, resource_id: Optional[str] = None, 
+                         parameters: Optional[Dict[str, Any]] = None) -> Optional[Dict]:
+        """Make a FHIR API request."""
+        if not self.access_token or time.monotonic() >= self._token_expiry:
+            self.get_access_token()
+            if not self.access_token:
+                return None
+
+        # Authorization varies per call (token refreshes); Accept is set
+        # once on the session
+        headers = {
+            'Authorization': f'Bearer {self.access_token}'
+        }
+
+        # Construct the URL
+        url = f"{self.fhir_endpoint}/{resource_type}"
+        if resource_id:
+            url = f"{url}/{resource_id}"
+
+        try:
+            data = None
+            # Use POST for batch translate operations
+            if resource_type == "ConceptMap/$translate":
+                # Create FHIR Parameters resource for single code or batch
+                if 'coding' in parameters:
+                    # Batch translate format
+                    codings = parameters['coding']
+                else:
+                    # Single code translate format
+                    codings = [{
+                        'system': parameters['system'],
+                        'code': parameters['code']
+                    }]
+
+                # Interpolate SNOMED codings straight into the prebuilt
+                # template; anything else goes through the dict path
+                if all(coding.get('system') == 'http://snomed.info/sct' and
+                       _SNOMED_CODE_RE.match(str(coding.get('code', '')))
+                       for coding in codings):
+                    data = _PARAMS_TEMPLATE % ','.join(
+                        _CODING_TEMPLATE % coding['code'] for coding in codings
+                    )
+                else:
+                    data = orjson.dumps({
+                        "resourceType": "Parameters",
+                        "parameter": [
+                            {
+                                "name": "coding",
+                                "valueCoding": coding
+                            } for coding in codings
+                        ]
+                    })
+
+            if data is not None:
+                headers['Content-Type'] = 'application/fhir+json'
+
+            for attempt in range(2):
+                if data is not None:
+                    response = self.session.post(url, headers=headers, data=data)
+                else:
+                    response = self.session.get(url, headers=headers, params=parameters)
+
+                if response.status_code != 401 or attempt:
+                    break
+                # Token rejected despite the expiry check - refresh once and retry
+                self.get_access_token(force=True)
+                headers['Authorization'] = f'Bearer {self.access_token}'
+
+            self.logger.info("Request URL: %s", response.url)
+            self.logger.info("Response Status: %s", response.status_code)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                # response.text decodes the full body - only pay for it
+                # when DEBUG is actually on
+                self.logger.debug("Request Body: %s", data)
+                self.logger.debug("Response Content: %s", response.text)
+
+            response.raise_for_status()
+            return orjson.loads(response.content)
+            
+        except requests.exceptions.RequestException as e:
+            self.logger.error("Error making FHIR request: %s", e)
+            if hasattr(e, 'response'):
+                self.logger.error("Response content: %s", e.response.text)
+                self.logger.error("Request headers: %s", e.response.request.headers)
+            return None
+
+    def map_snomed_to_icd10(self, snomed_code: str) -> Optional[Dict]:
+        """Map a SNOMED CT code to ICD-10 using FHIR ConceptMap."""
+        parameters = {
+            'code': snomed_code,
+            'system': 'http://snomed.info/sct'
+        }
+        
+        self.logger.info("Mapping SNOMED CT code: %s", snomed_code)
+        self.logger.debug("Parameters: %s", parameters)
+
+        return self.make_fhir_request(
+            resource_type="ConceptMap/$translate",
+            parameters=parameters
+        )
+
+    def map_snomed_codes_batch(self, snomed_codes: List[str]) -> Optional[Dict]:
+        """Map multiple SNOMED CT codes to ICD-10 using FHIR ConceptMap batch translate."""
+        parameters = {
+            'coding': [
+                {
+                    'system': 'http://snomed.info/sct',
+                    'code': code
+                } for code in snomed_codes
+            ]
+        }
+        
+        self.logger.info("Mapping batch of %d SNOMED CT codes", len(snomed_codes))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Parameters: %s", parameters)
+
+        result = self.make_fhir_request(
+            resource_type="ConceptMap/$translate",
+            parameters=parameters
+        )
+        
+        # Add response validation: the server returns one 'result' group
+        # per input code - misses carry no 'match' entries and multi-maps
+        # carry several, so 'match' count is the wrong thing to compare
+        if result and 'parameter' in result:
+            result_count = sum(1 for param in result['parameter'] if param['name'] == 'result')
+            self.logger.info("Received %d result groups for %d input codes", result_count, len(snomed_codes))
+            if result_count != len(snomed_codes):
+                self.logger.warning("Number of result groups doesn't match number of input codes!")
+        
+        return result
+
+class FHIRClientAsync:
+    """Async variant of FHIRClient built on aiohttp.
+
+    Holds many in-flight requests on one event loop instead of one
+    thread per request. Use as an async context manager so the
+    underlying session is opened and closed cleanly.
+    """
+
+    def __init__(self, cred_file: str = "cred.yml"):
+        self.logger = logging.getLogger(__name__)
+        self.access_token = None
+        self._token_expiry = 0.0
+        self._token_lock = asyncio.Lock()
+        self.session = None
+        self._load_credentials(cred_file)
+
+    def _load_credentials(self, cred_file: str) -> None:
+        """Load credentials from YAML file."""
+        try:
+            cred_path = Path(__file__).parent / cred_file
+            with open(cred_path, 'r') as file:
+                creds = yaml.safe_load(file)
+                self.client_id = creds['client_id']
+                self.client_secret = creds['client_secret']
+                self.token_endpoint = creds['token_endpoint']
+                self.fhir_endpoint = creds['fhir_endpoint']
+        except Exception as e:
+            self.logger.error("Error loading credentials: %s", e)
+            raise
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=64, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=30),
+            headers={'Accept': 'application/fhir+json'}
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.session.close()
+
+    async def get_access_token(self, force: bool = False) -> Optional[str]:
+        """Obtain OAuth2 access token. Safe to call from concurrent tasks."""
+        async with self._token_lock:
+            # Another task may have refreshed while we waited on the lock
+            if not force and self.access_token and time.monotonic() < self._token_expiry:
+                return self.access_token
+            return await self._refresh_access_token()
+
+    async def _refresh_access_token(self) -> Optional[str]:
+        try:
+            data = {
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret
+            }
+
+            async with self.session.post(self.token_endpoint, data=data) as response:
+                response.raise_for_status()
+                token_data = orjson.loads(await response.read())
+
+            self.access_token = token_data.get('access_token')
+            # Refresh a minute early so in-flight requests never carry a
+            # token that expires mid-request
+            expires_in = int(token_data.get('expires_in', 3600))
+            self._token_expiry = time.monotonic() + expires_in - 60
+            return self.access_token
+
+        except aiohttp.ClientError as e:
+            self.logger.error("Error obtaining access token: %s", e)
+            return None
+
+    async def make_fhir_request(self, resource_type: str, resource_id: Optional[str] = None,
+                                parameters: Optional[Dict[str, Any]] = None) -> Optional[Dict]:
+        """Make a FHIR API request."""
+        if not self.access_token or time.monotonic() >= self._token_expiry:
+            await self.get_access_token()
+            if not self.access_token:
+                return None
+
+        headers = {
+            'Authorization': f'Bearer {self.access_token}'
+        }
+
+        # Construct the URL
+        url = f"{self.fhir_endpoint}/{resource_type}"
+        if resource_id:
+            url = f"{url}/{resource_id}"
+
+        try:
+            data = None
+            # Use POST for batch translate operations
+            if resource_type == "ConceptMap/$translate":
+                # Create FHIR Parameters resource for single code or batch
+                if 'coding' in parameters:
+                    # Batch translate format
+                    data = {
+                        "resourceType": "Parameters",
+                        "parameter": [
+                            {
+                                "name": "coding",
+                                "valueCoding": coding
+                            } for coding in parameters['coding']
+                        ]
+                    }
+                else:
+                    # Single code translate format
+                    data = {
+                        "resourceType": "Parameters",
+                        "parameter": [
+                            {
+                                "name": "coding",
+                                "valueCoding": {
+                                    "system": parameters['system'],
+                                    "code": parameters['code']
+                                }
+                            }
+                        ]
+                    }
+
+            for attempt in range(2):
+                if data is not None:
+                    request = self.session.post(url, headers=headers, json=data)
+                else:
+                    request = self.session.get(url, headers=headers, params=parameters)
+
+                async with request as response:
+                    self.logger.info("Response Status: %s", response.status)
+                    if response.status == 401 and not attempt:
+                        # Token rejected despite the expiry check -
+                        # refresh once and retry
+                        await self.get_access_token(force=True)
+                        headers['Authorization'] = f'Bearer {self.access_token}'
+                        continue
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())
+
+        except aiohttp.ClientError as e:
+            self.logger.error("Error making FHIR request: %s", e)
+            return None
+
+    async def map_snomed_codes_batch(self, snomed_codes: List[str]) -> Optional[Dict]:
+        """Map multiple SNOMED CT codes to ICD-10 using FHIR ConceptMap batch translate."""
+        parameters = {
+            'coding': [
+                {
+                    'system': 'http://snomed.info/sct',
+                    'code': code
+                } for code in snomed_codes
+            ]
+        }
+
+        self.logger.info("Mapping batch of %d SNOMED CT codes", len(snomed_codes))
+
+        return await self.make_fhir_request(
+            resource_type="ConceptMap/$translate",
+            parameters=parameters
+        )
+
+# Number of SNOMED codes sent per $translate request
+BATCH_SIZE = 200
+
+# Maximum in-flight requests in async mode
+ASYNC_CONCURRENCY = 64
+
+# Buffered CSV rows accumulated before a writerows call
+CSV_FLUSH_ROWS = 500
+
+# Response-store inserts accumulated per transaction
+RESPONSE_DB_COMMIT_EVERY = 500
+
+# Completed batches buffered between the fetchers and the writer thread
+RESULT_QUEUE_DEPTH = 8
+
+def load_existing_snomed_set(output_file='output_codes.csv') -> set:
+    """Load the set of already-mapped SNOMED codes from the output file.
+
+    The main loop only needs membership tests, so keep just the SNOMED
+    column - csv.reader avoids DictReader's per-row dict materialization.
+    """
+    existing_codes = set()
+    try:
+        if os.path.exists(output_file):
+            with open(output_file, 'r', newline='') as csvfile:
+                reader = csv.reader(csvfile)
+                next(reader, None)  # Skip header
+                for row in reader:
+                    if len(row) > 1:
+                        existing_codes.add(row[1])
+    except Exception as e:
+        logging.error(f"Error loading existing mappings: {str(e)}")
+    return existing_codes
+
+# Bytes read from the end of a CSV when looking for the last ID
+TAIL_WINDOW = 65536
+
+def get_last_id(output_file):
+    """Get the last used ID from the CSV file.
+
+    IDs are appended monotonically, so the answer is in the last rows -
+    read a tail window backwards instead of scanning the whole file.
+    """
+    try:
+        if os.path.exists(output_file):
+            size = os.stat(output_file).st_size
+            with open(output_file, 'rb') as csvfile:
+                csvfile.seek(max(0, size - TAIL_WINDOW))
+                lines = csvfile.read().split(b'\n')
+
+            for line in reversed(lines):
+                if not line:
+                    continue
+                first_field = line.split(b',', 1)[0]
+                if first_field.isdigit():  # Ensure the ID column contains a number
+                    return int(first_field)
+
+            # No numeric ID in the tail window - fall back to a full scan
+            if size > TAIL_WINDOW:
+                with open(output_file, 'r', newline='') as csvfile:
+                    reader = csv.reader(csvfile)
+                    next(reader)  # Skip header
+                    last_id = 0
+                    for row in reader:
+                        if row and row[0].isdigit():
+                            last_id = int(row[0])
+                    return last_id
+    except Exception as e:
+        logging.error(f"Error reading last ID: {str(e)}")
+    return 0
+
+async def _fetch_batches_async(batches, handle_results):
+    """Fan batches out over one event loop with bounded concurrency.
+
+    Completed results are marshalled to the synchronous handle_results
+    callback, so CSV writing stays on the loop thread.
+    """
+    sem = asyncio.Semaphore(ASYNC_CONCURRENCY)
+
+    async with FHIRClientAsync() as client:
+        async def fetch(batch):
+            async with sem:
+                try:
+                    response = await client.map_snomed_codes_batch(batch)
+                    if response is None:
+                        # The client swallowed a request failure - record
+                        # the batch as errors, not as per-code misses
+                        raise RuntimeError("no response from FHIR server")
+                    mappings = extract_icd10_batch(response, batch)
+                except Exception as e:
+                    handle_results(batch, [], error=e)
+                else:
+                    handle_results(batch, mappings, response)
+
+        await asyncio.gather(*(fetch(batch) for batch in batches))
+
+def process_batch_codes(input_file, output_file='output_codes.csv', failed_file='failed_codes.csv', full_refresh=False, workers=16, use_async=False, dump_json=False, client: Optional[FHIRClient] = None):
+    # Reuse the caller's client (and its session/token) when given one
+    if client is None:
+        client = FHIRClient()
+
+    # Raw response retention is opt-in: one SQLite file instead of a
+    # directory full of tiny JSON files. Responses are keyed by the first
+    # code of their batch; lookup stays O(log N) via the primary key.
+    response_db = None
+    response_db_pending = 0
+    if dump_json:
+        os.makedirs('output', exist_ok=True)
+        # The writer thread does the inserts; write_lock already
+        # serializes access, so cross-thread use is safe
+        response_db = sqlite3.connect('output/responses.sqlite', check_same_thread=False)
+        response_db.execute('PRAGMA journal_mode=WAL')
+        response_db.execute('PRAGMA synchronous=NORMAL')
+        response_db.execute(
+            'CREATE TABLE IF NOT EXISTS responses (batch_start TEXT PRIMARY KEY, response BLOB)'
+        )
+
+    # Initialize counters
+    total_codes = 0
+    skipped_codes = 0
+    processed_codes = 0
+    error_codes = 0
+    
+    # Load already-mapped codes if not doing a full refresh
+    existing_codes = set() if full_refresh else load_existing_snomed_set(output_file)
+    
+    # Get the next ID number for successful mappings
+    current_id = 1 if full_refresh else get_last_id(output_file) + 1
+    
+    # Get the next ID number for failed mappings
+    failed_id = 1 if full_refresh else get_last_id(failed_file) + 1
+    
+    # Open output files in appropriate mode
+    mode = 'w' if full_refresh else 'a'
+    file_exists = os.path.exists(output_file)
+    failed_exists = os.path.exists(failed_file)
+    
+    with open(output_file, mode, newline='', buffering=1 << 20) as csvfile, \
+         open(failed_file, mode, newline='', buffering=1 << 20) as failedfile:
+        writer = csv.writer(csvfile)
+        failed_writer = csv.writer(failedfile)
+        
+        # Write headers if needed
+        if full_refresh or not file_exists:
+            writer.writerow(['ID', 'SNOMED', 'ICD10', 'TIMESTAMP'])
+        if full_refresh or not failed_exists:
+            failed_writer.writerow(['ID', 'SNOMED', 'ERROR', 'TIMESTAMP'])
+        
+        # Guards the writers and the ID counters when results land
+        write_lock = threading.Lock()
+
+        # Rows accumulate here and hit the writers in CSV_FLUSH_ROWS
+        # chunks, so syscall count stays low regardless of batch size
+        rows_buf = []
+        failed_buf = []
+
+        def fetch_batch(batch):
+            """Fetch and parse one batch. Runs on a worker thread."""
+            # One HTTP round-trip for the whole batch
+            response = client.map_snomed_codes_batch(batch)
+            if response is None:
+                # The client swallowed a request failure - record the
+                # batch as errors, not as per-code misses
+                raise RuntimeError("no response from FHIR server")
+
+            # Correlate results back to input codes
+            return extract_icd10_batch(response, batch), response
+
+        def write_batch_results(batch, mappings, response=None, error=None):
+            nonlocal current_id, failed_id, processed_codes, error_codes, response_db_pending
+
+            if error is not None:
+                logging.error(f"Error processing batch starting at {batch[0]}: {str(error)}")
+                mappings = []
+
+            # One timestamp per batch - strftime is pure overhead per row
+            ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+            with write_lock:
+                if response_db is not None and response is not None:
+                    response_db.execute(
+                        'INSERT OR REPLACE INTO responses VALUES (?, ?)',
+                        (batch[0], orjson.dumps(response))
+                    )
+                    response_db_pending += 1
+                    if response_db_pending >= RESPONSE_DB_COMMIT_EVERY:
+                        response_db.commit()
+                        response_db_pending = 0
+
+                for snomed_code, icd10_code in mappings:
+                    if icd10_code:  # Successful mapping
+                        rows_buf.append([
+                            current_id,
+                            snomed_code,
+                            icd10_code,
+                            ts
+                        ])
+                        current_id += 1
+                        processed_codes += 1
+                        logging.info(f"Processed {snomed_code} -> {icd10_code}")
+                    else:  # No mapping found
+                        error_codes += 1
+                        failed_buf.append([
+                            failed_id,
+                            snomed_code,
+                            "No mapping found",
+                            ts
+                        ])
+                        failed_id += 1
+                        logging.error(f"No mapping found for code {snomed_code}")
+
+                if error is not None:
+                    for snomed_code in batch:
+                        error_codes += 1
+                        failed_buf.append([
+                            failed_id,
+                            snomed_code,
+                            f"ERROR: {str(error)}",
+                            ts
+                        ])
+                        failed_id += 1
+
+                if len(rows_buf) >= CSV_FLUSH_ROWS:
+                    writer.writerows(rows_buf)
+                    rows_buf.clear()
+                if len(failed_buf) >= CSV_FLUSH_ROWS:
+                    failed_writer.writerows(failed_buf)
+                    failed_buf.clear()
+
+        # Read the input once and set-diff away the already-mapped codes
+        # instead of testing membership line by line. The format is one
+        # numeric code per line, so bulk-read the bytes and split once -
+        # no text-mode iteration or per-line strip()
+        with open(input_file, 'rb') as infile:
+            raw_lines = infile.read().split(b'\n')
+
+        input_codes = set()
+        for line in raw_lines:
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if line:
+                input_codes.add(line.decode('ascii'))
+
+        total_codes = len(input_codes)
+        if full_refresh:
+            todo = sorted(input_codes)
+        else:
+            todo = sorted(input_codes - existing_codes)
+            skipped_codes = total_codes - len(todo)
+            if skipped_codes:
+                logging.info(f"Skipping {skipped_codes} already-mapped codes")
+
+        batches = [todo[i:i + BATCH_SIZE] for i in range(0, len(todo), BATCH_SIZE)]
+
+        try:
+            if use_async:
+                # Single event loop holds all in-flight requests
+                asyncio.run(_fetch_batches_async(batches, write_batch_results))
+            else:
+                # Fan batches out across worker threads; requests releases the
+                # GIL during socket I/O so the fetches overlap. Completed
+                # results flow through a bounded queue to one writer thread,
+                # so CSV writes overlap with collecting the next result
+                # instead of stalling it
+                results_queue = queue.Queue(maxsize=RESULT_QUEUE_DEPTH)
+
+                # First write failure lands here; the loop keeps draining
+                # so producers never block on a full queue behind a dead
+                # writer
+                writer_error = []
+
+                def writer_loop():
+                    while True:
+                        item = results_queue.get()
+                        if item is None:
+                            break
+                        if writer_error:
+                            continue
+                        queued_batch, mappings, response, error = item
+                        try:
+                            write_batch_results(queued_batch, mappings, response, error)
+                        except Exception as e:
+                            writer_error.append(e)
+
+                writer_thread = threading.Thread(target=writer_loop, daemon=True)
+                writer_thread.start()
+                try:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        futures = {executor.submit(fetch_batch, b): b for b in batches}
+                        for future in as_completed(futures):
+                            fetched = futures[future]
+                            try:
+                                mappings, response = future.result()
+                            except Exception as e:
+                                results_queue.put((fetched, [], None, e))
+                            else:
+                                results_queue.put((fetched, mappings, response, None))
+                finally:
+                    results_queue.put(None)
+                    writer_thread.join()
+                    if writer_error:
+                        # Crash loudly rather than finish a run whose
+                        # results were silently dropped
+                        raise writer_error[0]
+        finally:
+            # Drain whatever the chunked flushes left behind
+            with write_lock:
+                writer.writerows(rows_buf)
+                rows_buf.clear()
+                failed_writer.writerows(failed_buf)
+                failed_buf.clear()
+
+    if response_db is not None:
+        response_db.commit()
+        response_db.close()
+
+    # Print summary statistics
+    print("\nProcessing Summary:")
+    print(f"Total codes found: {total_codes}")
+    print(f"Codes skipped (already mapped): {skipped_codes}")
+    print(f"Codes processed successfully: {processed_codes}")
+    print(f"Codes with errors/no mapping: {error_codes}")
+
+def extract_icd10_batch(response, snomed_codes):
+    """Correlate a batch $translate response back to its input codes.
+
+    The server returns one 'result' parameter per input coding, in input
+    order, each followed by its 'match' parameters. Returns a list of
+    (snomed_code, icd10_code) pairs where icd10_code is '' for misses.
+
+    Raises ValueError unless the response carries exactly one result
+    group per input code: positional pairing against a short response
+    silently shifts mappings onto the wrong codes, and output_codes.csv
+    is the permanent skip list, so such a batch must be recorded as an
+    error and retried rather than written.
+    """
+    parameters = response.get('parameter', ()) if response else ()
+    result_count = sum(1 for param in parameters if param.get('name') == 'result')
+    if result_count != len(snomed_codes):
+        raise ValueError(
+            f"$translate returned {result_count} result groups "
+            f"for {len(snomed_codes)} input codes"
+        )
+
+    icd10_codes = [''] * len(snomed_codes)
+    index = -1
+    result_ok = False
+    for param in parameters:
+        pname = sys.intern(param['name'])
+        if pname is _RESULT:
+            index += 1
+            # result=false means no match for this code - the
+            # group's match parts hold nothing worth walking
+            result_ok = param.get('valueBoolean', False)
+        elif (pname is _MATCH and
+              result_ok and
+              not icd10_codes[index]):
+            for part in param.get('part', []):
+                if sys.intern(part.get('name', '')) is _CONCEPT:
+                    coding = part.get('valueCoding')
+                    if coding is not None and coding.get('system') == _ICD10_SYSTEM:
+                        icd10_codes[index] = coding.get('code', '')
+                        break
+    return list(zip(snomed_codes, icd10_codes))
+
+def fast_extract(parameters):
+    """Fast-path extraction assuming the stable $translate layout.
+
+    The server emits parameter[0] as 'result' followed by 'match'
+    entries whose first part is the 'concept' coding. Returns the
+    ICD-10 code ('' for a confirmed miss), or None when the layout
+    assumption does not hold and the robust parser should take over.
+    """
+    try:
+        first = parameters[0]
+        if first['name'] != 'result':
+            return None
+        if not first.get('valueBoolean', False):
+            return ''  # Confirmed miss - nothing else to look at
+
+        for param in parameters[1:]:
+            if param['name'] != 'match':
+                continue
+            part = param['part'][0]
+            if part['name'] != 'concept':
+                return None
+            coding = part['valueCoding']
+            if coding['system'] == _ICD10_SYSTEM:
+                return coding['code']
+            # concept in an unexpected system - let the robust parser
+            # search the remaining parts
+            return None
+
+        return ''
+    except (KeyError, IndexError, TypeError):
+        return None
+
+def extract_icd10_from_response(response):
+    """Extract ICD-10 code from the FHIR response"""
+    try:
+        if not response or 'parameter' not in response:
+            return ''
+
+        # Try the shape-specialized parser first; it answers directly
+        # for the layout the server actually sends
+        fast = fast_extract(response['parameter'])
+        if fast is not None:
+            return fast
+
+        # Single pass: note the result flag, then return the first
+        # ICD-10 coding found among the match parts
+        result_ok = False
+        for param in response['parameter']:
+            pname = sys.intern(param.get('name', ''))
+            if pname is _RESULT:
+                result_ok = param.get('valueBoolean', False)
+                if not result_ok:  # No match at all
+                    return ''
+            elif pname is _MATCH and result_ok:
+                for part in param.get('part', ()):
+                    if sys.intern(part.get('name', '')) is _CONCEPT:
+                        coding = part.get('valueCoding')
+                        if coding is not None and coding.get('system') == _ICD10_SYSTEM:
+                            return coding.get('code', '')
+
+        return ''  # Return empty string if no mapping found
+
+    except Exception as e:
+        logging.error(f"Error extracting ICD-10 code: {str(e)}")
+        return ''
+
+def process_single_code(snomed_code, output_file='output_codes.csv', failed_file='failed_codes.csv', full_refresh=False, client: Optional[FHIRClient] = None):
+    """Map one SNOMED code and append the result to the output CSVs."""
+    if client is None:
+        client = FHIRClient()
+
+    if not full_refresh and snomed_code in load_existing_snomed_set(output_file):
+        print(f"Skipping {snomed_code} - already mapped")
+        return
+
+    # A full refresh starts both CSVs over, whichever one this code ends
+    # up in - matching the batch path, which truncates both up front
+    if full_refresh:
+        with open(output_file, 'w', newline='') as csvfile:
+            csv.writer(csvfile).writerow(['ID', 'SNOMED', 'ICD10', 'TIMESTAMP'])
+        with open(failed_file, 'w', newline='') as failedfile:
+            csv.writer(failedfile).writerow(['ID', 'SNOMED', 'ERROR', 'TIMESTAMP'])
+
+    response = client.map_snomed_to_icd10(snomed_code)
+
+    # result=false sits first in the parameter list - skip extraction
+    # entirely when the server already said there is no match
+    params = response.get('parameter') if response else None
+    if (params and params[0].get('name') == 'result' and
+            params[0].get('valueBoolean') is False):
+        icd10_code = ''
+    else:
+        icd10_code = extract_icd10_from_response(response)
+    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    if icd10_code:
+        next_id = 1 if full_refresh else get_last_id(output_file) + 1
+        file_exists = os.path.exists(output_file)
+        with open(output_file, 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            if not file_exists:
+                writer.writerow(['ID', 'SNOMED', 'ICD10', 'TIMESTAMP'])
+            writer.writerow([next_id, snomed_code, icd10_code, ts])
+        print(f"Processed {snomed_code} -> {icd10_code}")
+    else:
+        next_id = 1 if full_refresh else get_last_id(failed_file) + 1
+        failed_exists = os.path.exists(failed_file)
+        with open(failed_file, 'a', newline='') as failedfile:
+            failed_writer = csv.writer(failedfile)
+            if not failed_exists:
+                failed_writer.writerow(['ID', 'SNOMED', 'ERROR', 'TIMESTAMP'])
+            failed_writer.writerow([next_id, snomed_code, "No mapping found", ts])
+        print(f"No mapping found for code {snomed_code}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Map SNOMED CT codes to ICD-10')
+    parser.add_argument('--batch', type=str, help='Input file containing SNOMED CT codes (one per line)')
+    parser.add_argument('--code', type=str, help='Single SNOMED CT code to map')
+    parser.add_argument('--full-refresh', action='store_true', help='Clear output file and process all codes')
+    parser.add_argument('--workers', type=int, default=16, help='Number of concurrent request threads')
+    parser.add_argument('--use-async', action='store_true', help='Use asyncio/aiohttp instead of threads for batch fetching')
+    parser.add_argument('--dump-json', action='store_true', help='Save raw API responses to output/responses.sqlite')
+    args = parser.parse_args()
+    
+    # Set up logging
+    logging.basicConfig(level=logging.INFO)
+    
+    # Create FHIR client instance
+    client = FHIRClient()
+    
+    if args.batch:
+        # Process batch file
+        process_batch_codes(args.batch, full_refresh=args.full_refresh, workers=args.workers, use_async=args.use_async, dump_json=args.dump_json, client=client)
+        print(f"Results written to output_codes.csv")
+    elif args.code:
+        # Map the single code directly - no temp file round-trip
+        process_single_code(args.code, full_refresh=args.full_refresh, client=client)
+        print(f"Results written to output_codes.csv")
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
     main() 
\ No newline at end of file